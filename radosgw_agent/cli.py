@@ -16,7 +16,7 @@ from urllib2 import URLError, HTTPError
 import radosgw_agent
 from radosgw_agent import client
 from radosgw_agent import util
-from radosgw_agent.util import string
+from radosgw_agent.util import hashing, string
 from radosgw_agent.util.decorators import catches
 from radosgw_agent.exceptions import AgentError, RegionMapError, InvalidProtocol
 from radosgw_agent import sync, config
@@ -178,6 +178,14 @@ def parse_args():
         help='seconds to wait before retrying when preparing '
         'an incremental sync fails',
         )
+    parser.add_argument(
+        '--shard-hash-algo',
+        choices=['legacy', 'mmh3'],
+        default='legacy',
+        help='hash used to map keys to log shards. mmh3 (requires the '
+             'mmh3 package) balances shards better, but every agent '
+             'instance syncing a zone must use the same setting',
+        )
     parser.add_argument(
         '--rgw-data-log-window',
         type=check_positive_int,
@@ -198,7 +206,10 @@ def parse_args():
         help=argparse.SUPPRESS,
         )
     parser.set_defaults(**defaults)
-    return parser.parse_args(remaining)
+    args = parser.parse_args(remaining)
+    if args.shard_hash_algo == 'mmh3' and hashing.mmh3 is None:
+        parser.error('--shard-hash-algo mmh3 requires the mmh3 package')
+    return args
 
 
 def sign_string(
@@ -286,10 +297,13 @@ class TestHandler(BaseHTTPRequestHandler):
                                   rgw_data_log_window=TestHandler.rgw_data_log_window,
                                   object_sync_timeout=TestHandler.object_sync_timeout)
                 syncer.prepare()
-                syncer.sync(
-                    TestHandler.num_workers,
-                    TestHandler.lock_timeout,
-                    )
+                try:
+                    syncer.sync(
+                        TestHandler.num_workers,
+                        TestHandler.lock_timeout,
+                        )
+                finally:
+                    syncer.stop_workers()
         except Exception as e:
             log.exception('error during sync')
             status = 500
@@ -467,9 +481,11 @@ def main():
     if args.sync_scope == 'full':
         log.info('syncing all metadata')
         meta_syncer.sync(args.num_workers, args.lock_timeout)
+        meta_syncer.stop_workers()
         if not args.metadata_only:
             log.info('syncing all data')
             data_syncer.sync(args.num_workers, args.lock_timeout)
+            data_syncer.stop_workers()
         log.info('Finished full sync. Check logs to see any issues that '
                  'incremental sync will retry.')
     else:
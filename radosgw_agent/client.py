@@ -210,12 +210,18 @@ def request(connection, type_, resource, params=None, headers=None,
     except BotoServerError as error:
         check_result_status(error)
 
+    # drain the body before any status check so the connection goes
+    # back to boto's pool in a reusable state; an unread response (on
+    # errors like NotFound too) forces a new TCP (and possibly TLS)
+    # setup for every request that follows
+    body = result.read()
+
     check_result_status(result)
 
     if data or not expect_json:
         return result
 
-    return json.loads(result.read())
+    return json.loads(body)
 
 
 def get_metadata(connection, section, name):
@@ -268,6 +274,18 @@ def get_bucket_list(connection):
     return list_metadata_keys(connection, 'bucket')
 
 
+def iter_bucket_list(connection):
+    """Yield bucket names one at a time.
+
+    The admin metadata api currently returns the whole listing in one
+    response; this generator keeps callers from holding a second
+    reference to it, and means a paged listing can be dropped in here
+    without touching them.
+    """
+    for bucket in list_metadata_keys(connection, 'bucket'):
+        yield bucket
+
+
 @boto_call
 def list_objects_in_bucket(connection, bucket_name):
     versioned = config['use_versioning']
@@ -492,7 +510,9 @@ def set_worker_bound(connection, type_, marker, timestamp,
             'daemon_id': daemon_id,
             'sync-type': sync_type,
             },
-        data=json.dumps(data),
+        # compact separators: this is serialized once per bound update,
+        # and shards with many retries make the default payload large
+        data=json.dumps(data, separators=(',', ':')),
         special_first_param='work_bound',
         )
 
@@ -1,10 +1,16 @@
+from collections import defaultdict
+from itertools import islice, izip
 import logging
 import multiprocessing
+from Queue import Empty
+from multiprocessing.pool import ThreadPool
+import threading
 import time
 
 from radosgw_agent import worker
 from radosgw_agent import client
-from radosgw_agent.util import get_dev_logger
+from radosgw_agent import config
+from radosgw_agent.util import cache, get_dev_logger, hashing
 from radosgw_agent.exceptions import NotFound, HttpError
 
 
@@ -17,6 +23,17 @@ dev_log = get_dev_logger(__name__)
 # radosgw-agent, so just use a constant value for the daemon id.
 DAEMON_ID = 'radosgw-agent'
 
+# how many worker bound updates to buffer before flushing them, and how
+# many round-trips a flush may have in flight at once
+BOUND_FLUSH_COUNT = 32
+BOUND_FLUSH_THREADS = 8
+
+# how long fetched per-shard state (log info, worker bounds) may be
+# served from memory: long enough to span prepare() retries, which
+# default to 10 seconds apart, while bounding how stale a bound set by
+# another agent instance can appear
+FETCH_CACHE_TTL = 30
+
 def prepare_sync(syncer, error_delay):
     """Attempt to prepare a syncer for running a sync.
 
@@ -69,6 +86,20 @@ class Syncer(object):
         self.num_shards = None
         self.max_entries = max_entries
         self.object_sync_timeout = kwargs.get('object_sync_timeout')
+        self._pending_bounds = []
+        # lazily created thread pools that live as long as the syncer,
+        # so their per-thread connections stay warm across sync cycles
+        self._threadlocal = threading.local()
+        self._bound_pool = None
+        self._fetch_pool = None
+        self._fetch_cache = cache.TTLCache(maxsize=4096, ttl=FETCH_CACHE_TTL)
+        args = config.get('args') or {}
+        self.shard_hash_algo = args.get('shard_hash_algo') or 'legacy'
+        # the worker pool and its queues outlive one sync() call; see
+        # start_workers()
+        self._processes = None
+        self._work_queues = None
+        self._result_queue = None
 
     def init_num_shards(self):
         if self.num_shards is not None:
@@ -81,12 +112,46 @@ class Syncer(object):
             raise
 
     def shard_num_for_key(self, key):
-        key = key.encode('utf8')
-        hash_val = 0
-        for char in key:
-            c = ord(char)
-            hash_val = (hash_val + (c << 4) + (c >> 4)) * 11
-        return hash_val % self.num_shards
+        return self.shard_nums_for_keys([key])[0]
+
+    def shard_nums_for_keys(self, keys, prefix=''):
+        """Shard numbers for a batch of keys under the configured hash.
+
+        ``prefix`` is a string logically prepended to every key.
+        """
+        if self.shard_hash_algo == 'mmh3':
+            # mmh3 has no composable prefix state, hash whole strings
+            return [hashing.mmh3_shard_num_for_key(prefix + key,
+                                                   self.num_shards)
+                    for key in keys]
+        return hashing.shard_nums_for_keys(keys, self.num_shards,
+                                           hashing.prefix_hash(prefix))
+
+    def thread_connections(self):
+        """Per-thread (src, dest) connection pair.
+
+        boto connections cannot be shared across threads, but they do
+        keep their sockets alive, so threads of the long-lived pools
+        reuse their own pair instead of reconnecting every cycle.
+        """
+        local = self._threadlocal
+        if getattr(local, 'src_conn', None) is None:
+            local.src_conn = client.connection(self.src)
+            local.dest_conn = client.connection(self.dest)
+        return local.src_conn, local.dest_conn
+
+    def get_log_info(self, shard_num):
+        """client.get_log_info() behind the syncer's fetch cache.
+
+        prepare() is retried from scratch when any shard fails, so the
+        cache lets a retry skip the shards that already answered.
+        """
+        key = ('log_info', self.type, shard_num)
+        info = self._fetch_cache.get(key)
+        if info is None:
+            info = client.get_log_info(self.src_conn, self.type, shard_num)
+            self._fetch_cache.set(key, info)
+        return info
 
     def prepare(self):
         """Setup any state required before syncing starts.
@@ -107,79 +172,165 @@ class Syncer(object):
         marker = self.shard_info.get(shard_num)
         if not marker:
             return
-        try:
-            data = [dict(name=retry, time=worker.DEFAULT_TIME)
-                    for retry in retries]
-            client.set_worker_bound(self.dest_conn,
-                                    self.type,
-                                    marker,
-                                    worker.DEFAULT_TIME,
-                                    self.daemon_id,
-                                    shard_num,
-                                    data)
-        except Exception:
-            log.warn('could not set worker bounds, may repeat some work.'
-                     'Traceback:', exc_info=True)
+        data = [dict(name=retry, time=worker.DEFAULT_TIME)
+                for retry in retries]
+        self._pending_bounds.append((shard_num, marker, data))
+        if len(self._pending_bounds) >= BOUND_FLUSH_COUNT:
+            self.flush_pending_bounds()
+
+    def flush_pending_bounds(self):
+        """Send any worker bound updates buffered by complete_item().
+
+        Each update is one round-trip to the destination, so a batch is
+        pushed by a pool of threads rather than one bound at a time off
+        the result loop.
+        """
+        pending, self._pending_bounds = self._pending_bounds, []
+        if not pending:
+            return
 
-    def sync(self, num_workers, log_lock_time):
-        workQueue = multiprocessing.Queue()
-        resultQueue = multiprocessing.Queue()
-
-        processes = [self.worker_cls(workQueue,
-                                     resultQueue,
-                                     log_lock_time,
-                                     self.src,
-                                     self.dest,
-                                     daemon_id=self.daemon_id,
-                                     max_entries=self.max_entries,
-                                     object_sync_timeout=self.object_sync_timeout,
-                                     )
-                     for i in xrange(num_workers)]
-        for process in processes:
+        def set_bound(pending_bound):
+            shard_num, marker, data = pending_bound
+            try:
+                client.set_worker_bound(self.thread_connections()[1],
+                                        self.type,
+                                        marker,
+                                        worker.DEFAULT_TIME,
+                                        self.daemon_id,
+                                        shard_num,
+                                        data)
+                # the stored bound changed, don't serve the old one
+                self._fetch_cache.invalidate(('bound', self.type, shard_num))
+            except Exception:
+                log.warn('could not set worker bounds, may repeat some work.'
+                         'Traceback:', exc_info=True)
+
+        if self._bound_pool is None:
+            self._bound_pool = ThreadPool(BOUND_FLUSH_THREADS)
+        self._bound_pool.map(set_bound, pending)
+
+    def start_workers(self, num_workers, log_lock_time):
+        """Create the worker pool, or replace workers that have died.
+
+        The pool and its queues outlive one sync() call, so a daemon
+        doing incremental sync reuses the same processes - and their
+        locks and warm connections - every cycle instead of paying
+        process and connection setup per cycle. There is one work queue
+        per worker, with shards assigned by shard number: a given shard
+        is always handled by the same worker, so its lock and keep-alive
+        connection state stay in one place and workers never contend for
+        the same queue.
+        """
+        if self._processes is None:
+            self._work_queues = [multiprocessing.Queue()
+                                 for i in xrange(num_workers)]
+            self._result_queue = multiprocessing.Queue()
+            self._processes = [None] * num_workers
+        for i, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                log.error('worker %d died, replacing it', process.pid)
+            process = self.worker_cls(self._work_queues[i],
+                                      self._result_queue,
+                                      log_lock_time,
+                                      self.src,
+                                      self.dest,
+                                      daemon_id=self.daemon_id,
+                                      max_entries=self.max_entries,
+                                      object_sync_timeout=self.object_sync_timeout,
+                                      )
             process.daemon = True
             process.start()
+            self._processes[i] = process
+
+    def stop_workers(self):
+        """Shut the worker pool down and wait for the processes to exit."""
+        if self._processes is None:
+            return
+        for queue in self._work_queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join()
+        self._processes = None
+        self._work_queues = None
+        self._result_queue = None
+
+    def sync(self, num_workers, log_lock_time):
+        self.start_workers(num_workers, log_lock_time)
+        # the pool size is fixed on the first cycle
+        num_workers = len(self._work_queues)
 
         self.wait_until_ready()
 
         log.info('Starting sync')
-        # enqueue the shards to be synced
+        # discard results of items abandoned in an earlier cycle
+        while True:
+            try:
+                self._result_queue.get_nowait()
+            except Empty:
+                break
+
         num_items = 0
         for item in self.generate_work():
             num_items += 1
-            workQueue.put(item)
-
-        # add a poison pill for each worker
-        for i in xrange(num_workers):
-            workQueue.put(None)
-
-        # pull the results out as they are produced
-        retries = {}
-        for i in xrange(num_items):
-            result, item = resultQueue.get()
-            shard_num, retries = item
+            self._work_queues[item[0] % num_workers].put(item)
+
+        # pull the results out as they are produced; blocking on exactly
+        # one result per item would hang forever if a worker died
+        # without reporting, so wake up periodically and check on them.
+        # a replacement worker picks up the dead one's queue, but the
+        # item that was in flight is gone until next cycle, so stop
+        # expecting one result per death
+        failed_shards = []
+        completed = 0
+        lost = 0
+        while completed + lost < num_items:
+            try:
+                result, item = self._result_queue.get(timeout=30)
+            except Empty:
+                dead = [p for p in self._processes if not p.is_alive()]
+                if dead:
+                    lost += len(dead)
+                    self.start_workers(num_workers, log_lock_time)
+                continue
+            completed += 1
+            shard_num, item_retries = item
             if result == worker.RESULT_SUCCESS:
                 log.debug('synced item %r successfully', item)
-                self.complete_item(shard_num, retries)
+                self.complete_item(shard_num, item_retries)
             else:
                 log.error('error syncing shard %d', shard_num)
-                retries.append(shard_num)
-
-            log.info('%d/%d items processed', i + 1, num_items)
-        if retries:
+                failed_shards.append(shard_num)
+
+            log.info('%d/%d items processed', completed, num_items)
+        self.flush_pending_bounds()
+        if lost:
+            log.error('%d items were abandoned by dying workers and will '
+                      'be picked up next cycle', lost)
+        if failed_shards:
             log.error('Encountered errors syncing these %d shards: %r',
-                      len(retries), retries)
+                      len(failed_shards), failed_shards)
 
 
 class IncrementalSyncer(Syncer):
 
-    def get_worker_bound(self, shard_num):
+    def get_worker_bound(self, shard_num, conn=None):
+        key = ('bound', self.type, shard_num)
+        cached = self._fetch_cache.get(key)
+        if cached is not None:
+            return cached
+
+        if conn is None:
+            conn = self.dest_conn
         bound = client.get_worker_bound(
-            self.dest_conn,
+            conn,
             self.type,
             shard_num)
 
         marker = bound['marker']
         retries = bound['retries']
+        self._fetch_cache.set(key, (marker, retries))
 
         dev_log.debug('oldest marker and time for shard %d are: %r %r',
                       shard_num, marker, bound['oldest_time'])
@@ -188,9 +339,11 @@ class IncrementalSyncer(Syncer):
         return marker, retries
 
 
-    def get_log_entries(self, shard_num, marker):
+    def get_log_entries(self, shard_num, marker, conn=None):
+        if conn is None:
+            conn = self.src_conn
         try:
-            result = client.get_log(self.src_conn, self.type,
+            result = client.get_log(conn, self.type,
                                     marker, self.max_entries,
                                     shard_num)
             last_marker = result['marker']
@@ -207,11 +360,26 @@ class IncrementalSyncer(Syncer):
     def prepare(self):
         self.init_num_shards()
 
+        def fetch_shard(shard_num):
+            # preparing a shard is two blocking round-trips, so shards
+            # are fetched on a pool of threads with their own warm
+            # connections
+            src_conn, dest_conn = self.thread_connections()
+            marker, retries = self.get_worker_bound(shard_num, dest_conn)
+            last_marker, log_entries = self.get_log_entries(shard_num, marker,
+                                                            src_conn)
+            return shard_num, last_marker, log_entries, retries
+
+        results = []
+        if self.num_shards:
+            if self._fetch_pool is None:
+                self._fetch_pool = ThreadPool(min(self.num_shards, 32))
+            results = self._fetch_pool.map(fetch_shard,
+                                           xrange(self.num_shards))
+
         self.shard_info = {}
         self.shard_work = {}
-        for shard_num in xrange(self.num_shards):
-            marker, retries = self.get_worker_bound(shard_num)
-            last_marker, log_entries = self.get_log_entries(shard_num, marker)
+        for shard_num, last_marker, log_entries, retries in results:
             self.shard_work[shard_num] = log_entries, retries
             self.shard_info[shard_num] = last_marker
 
@@ -239,8 +407,9 @@ class DataSyncerInc(IncrementalSyncer):
 
     def wait_until_ready(self):
         log.info('waiting to make sure bucket log is consistent')
-        while time.time() < self.prepared_at + self.rgw_data_log_window:
-            time.sleep(1)
+        delay = self.prepared_at + self.rgw_data_log_window - time.time()
+        if delay > 0:
+            time.sleep(delay)
 
 
 class DataSyncerFull(Syncer):
@@ -258,7 +427,7 @@ class DataSyncerFull(Syncer):
         # save data log markers for each shard
         self.shard_info = {}
         for shard in xrange(self.num_shards):
-            info = client.get_log_info(self.src_conn, 'data', shard)
+            info = self.get_log_info(shard)
             # setting an empty marker returns an error
             if info['marker']:
                 self.shard_info[shard] = info['marker']
@@ -268,23 +437,30 @@ class DataSyncerFull(Syncer):
         # get list of buckets after getting any markers to avoid skipping
         # entries added before we got the marker info
         log.debug('getting bucket list')
-        buckets = client.get_bucket_list(self.src_conn)
+        buckets = client.iter_bucket_list(self.src_conn)
+
+        # group the listing as it streams, hashing a slab at a time, so
+        # prepare holds the grouped dict rather than that plus its own
+        # copy of the full listing
+        self.buckets_by_shard = buckets_by_shard = defaultdict(list)
+        while True:
+            batch = list(islice(buckets, 10000))
+            if not batch:
+                break
+            shards = self.shard_nums_for_keys(batch)
+            for bucket, shard in izip(batch, shards):
+                buckets_by_shard[shard].append(bucket)
 
         self.prepared_at = time.time()
 
-        self.buckets_by_shard = {}
-        for bucket in buckets:
-            shard = self.shard_num_for_key(bucket)
-            self.buckets_by_shard.setdefault(shard, [])
-            self.buckets_by_shard[shard].append(bucket)
-
     def generate_work(self):
         return self.buckets_by_shard.iteritems()
 
     def wait_until_ready(self):
         log.info('waiting to make sure bucket log is consistent')
-        while time.time() < self.prepared_at + self.rgw_data_log_window:
-            time.sleep(1)
+        delay = self.prepared_at + self.rgw_data_log_window - time.time()
+        if delay > 0:
+            time.sleep(delay)
 
 
 class MetaSyncerFull(Syncer):
@@ -304,27 +480,46 @@ class MetaSyncerFull(Syncer):
         self.shard_info = {}
         self.init_num_shards()
         for shard_num in xrange(self.num_shards):
-            info = client.get_log_info(self.src_conn, 'metadata', shard_num)
+            info = self.get_log_info(shard_num)
             # setting an empty marker returns an error
             if info['marker']:
                 self.shard_info[shard_num] = info['marker']
             else:
                 self.shard_info[shard_num] = ' '
 
-        self.metadata_by_shard = {}
-        for section in self.sections:
+        def list_section(section):
+            # each listing is one blocking round-trip, so the sections
+            # are fetched on their own threads; boto connections are not
+            # safe to share across threads, so each thread gets its own
             try:
-                for key in client.list_metadata_keys(self.src_conn, section):
-                    shard = self.shard_num_for_key(section + ':' + key)
-                    self.metadata_by_shard.setdefault(shard, [])
-                    self.metadata_by_shard[shard].append((section, key))
+                return client.list_metadata_keys(client.connection(self.src),
+                                                 section)
             except NotFound:
                 # no keys of this type exist
-                continue
+                return []
             except HttpError as e:
                 log.error('Error listing metadata for section %s: %s',
                           section, e)
                 raise
 
+        keys_by_section = []
+        if self.sections:
+            pool = ThreadPool(min(len(self.sections), 16))
+            try:
+                keys_by_section = pool.map(list_section, self.sections)
+            finally:
+                pool.close()
+                pool.join()
+
+        # hash each section's keys in one batch, then one lookup and
+        # append per key
+        self.metadata_by_shard = metadata_by_shard = defaultdict(list)
+        for section, keys in zip(self.sections, keys_by_section):
+            # every key in a section is hashed as 'section:key'; the
+            # shared prefix is folded in once per section, not per key
+            shards = self.shard_nums_for_keys(keys, section + ':')
+            for key, shard in izip(keys, shards):
+                metadata_by_shard[shard].append((section, key))
+
     def generate_work(self):
         return self.metadata_by_shard.iteritems()
@@ -0,0 +1,47 @@
+from radosgw_agent.util import cache
+
+
+class TestTTLCache(object):
+
+    def test_get_returns_stored_value(self):
+        c = cache.TTLCache(ttl=60)
+        c.set('key', 'value')
+        assert c.get('key') == 'value'
+
+    def test_missing_key_returns_default(self):
+        c = cache.TTLCache(ttl=60)
+        assert c.get('key') is None
+        assert c.get('key', 'fallback') == 'fallback'
+
+    def test_expired_entry_is_a_miss(self):
+        c = cache.TTLCache(ttl=-1)
+        c.set('key', 'value')
+        assert c.get('key') is None
+
+    def test_invalidate_removes_entry(self):
+        c = cache.TTLCache(ttl=60)
+        c.set('key', 'value')
+        c.invalidate('key')
+        assert c.get('key') is None
+
+    def test_invalidate_missing_key_is_harmless(self):
+        c = cache.TTLCache(ttl=60)
+        c.invalidate('key')
+
+    def test_oldest_entry_evicted_at_maxsize(self):
+        c = cache.TTLCache(maxsize=2, ttl=60)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.set('c', 3)
+        assert c.get('a') is None
+        assert c.get('b') == 2
+        assert c.get('c') == 3
+
+    def test_reset_key_is_not_evicted_first(self):
+        c = cache.TTLCache(maxsize=2, ttl=60)
+        c.set('a', 1)
+        c.set('b', 2)
+        c.set('a', 3)
+        c.set('c', 4)
+        assert c.get('b') is None
+        assert c.get('a') == 3
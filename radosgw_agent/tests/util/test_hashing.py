@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from radosgw_agent.util import hashing
+
+
+def reference_shard_num(key, num_shards):
+    # the original per-character implementation, kept as a reference
+    key = key.encode('utf8')
+    hash_val = 0
+    for char in key:
+        c = ord(char)
+        hash_val = (hash_val + (c << 4) + (c >> 4)) * 11
+    return hash_val % num_shards
+
+
+class TestShardNumForKey(object):
+
+    def test_matches_reference_implementation(self):
+        for key in ['', 'bucket', 'user:foo', 'a.b-c_d', 'a' * 1024]:
+            assert hashing.shard_num_for_key(key, 64) == \
+                reference_shard_num(key, 64)
+
+    def test_handles_unicode_keys(self):
+        assert hashing.shard_num_for_key(u'bucket-é', 64) == \
+            reference_shard_num(u'bucket-é', 64)
+
+    def test_byte_keys_hash_like_their_unicode_form(self):
+        assert hashing.shard_num_for_key(u'bucket-é'.encode('utf8'), 64) == \
+            hashing.shard_num_for_key(u'bucket-é', 64)
+
+    def test_result_is_within_shard_range(self):
+        for key in ['one', 'two', 'three', 'four']:
+            assert 0 <= hashing.shard_num_for_key(key, 11) < 11
+
+
+class TestShardNumsForKeys(object):
+
+    def test_matches_single_key_hashing(self):
+        keys = ['alice', 'bob', 'carol', '']
+        assert hashing.shard_nums_for_keys(keys, 64) == \
+            [hashing.shard_num_for_key(key, 64) for key in keys]
+
+    def test_prefix_applies_to_every_key(self):
+        keys = ['alice', 'bob']
+        prefix = hashing.prefix_hash('user:')
+        assert hashing.shard_nums_for_keys(keys, 64, prefix) == \
+            [hashing.shard_num_for_key('user:' + key, 64) for key in keys]
+
+    def test_empty_batch(self):
+        assert hashing.shard_nums_for_keys([], 64) == []
+
+
+class TestMmh3ShardNumForKey(object):
+
+    def test_result_is_within_shard_range(self):
+        pytest.importorskip('mmh3')
+        for key in ['one', 'two', 'three', 'four']:
+            assert 0 <= hashing.mmh3_shard_num_for_key(key, 11) < 11
+
+    def test_unicode_and_bytes_forms_agree(self):
+        pytest.importorskip('mmh3')
+        assert hashing.mmh3_shard_num_for_key(u'bucket-é', 64) == \
+            hashing.mmh3_shard_num_for_key(u'bucket-é'.encode('utf8'), 64)
+
+
+class TestPrefixHash(object):
+
+    def test_prefix_then_suffix_matches_whole_key(self):
+        whole = hashing.shard_num_for_key('user:alice', 64)
+        prefix = hashing.prefix_hash('user:')
+        assert hashing.shard_num_for_key('alice', 64, prefix) == whole
+
+    def test_empty_prefix_is_a_no_op(self):
+        assert hashing.prefix_hash('') == 0
+        assert hashing.shard_num_for_key('key', 64, hashing.prefix_hash('')) \
+            == hashing.shard_num_for_key('key', 64)
@@ -0,0 +1,42 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """A small mapping whose entries expire after a fixed time.
+
+    Reads of expired entries behave as misses, and the oldest entry is
+    evicted once maxsize is reached. This is intentionally tiny - just
+    enough to short-circuit refetching values that rarely change
+    between retries or sync cycles. Safe to use from multiple threads.
+    """
+
+    def __init__(self, maxsize=4096, ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            value, expires_at = item
+            if expires_at < time.time():
+                del self._items[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._items:
+                del self._items[key]
+            elif len(self._items) >= self.maxsize:
+                self._items.popitem(last=False)
+            self._items[key] = (value, time.time() + self.ttl)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
@@ -0,0 +1,75 @@
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
+# (c << 4) + (c >> 4) precomputed for every byte value: the fold below
+# then costs one table lookup instead of two shifts and an add per byte
+_ROT = [(c << 4) + (c >> 4) for c in range(256)]
+
+
+def prefix_hash(data, seed=0):
+    """Hash ``data`` without reducing it to a shard number.
+
+    The hash folds in one byte at a time, so it composes: the value for
+    a prefix shared by many keys can be computed once and passed back in
+    as ``seed`` when hashing each key.
+    """
+    # only unicode needs encoding; a str is hashed as the bytes it
+    # already is (str.encode would decode it as ascii first and blow
+    # up on high bytes)
+    if isinstance(data, unicode):
+        data = data.encode('utf8')
+    hash_val = seed
+    rot = _ROT
+    # iterating a bytearray yields ints directly, avoiding a per-byte
+    # ord() call in what is the hottest loop of a full sync prepare
+    for c in bytearray(data):
+        hash_val = (hash_val + rot[c]) * 11
+    return hash_val
+
+
+def shard_num_for_key(key, num_shards, prefix=0):
+    """Map a metadata or data log key to the shard its entries live in.
+
+    This is the same hash radosgw uses to assign keys to log shards, so
+    it must not change independently of the gateway. ``prefix`` is the
+    ``prefix_hash()`` of any bytes that logically precede ``key``.
+    """
+    return prefix_hash(key, prefix) % num_shards
+
+
+def shard_nums_for_keys(keys, num_shards, prefix=0):
+    """shard_num_for_key() for a whole batch of keys.
+
+    The per-key fold is inlined so hashing a large batch pays for one
+    call and one set of locals instead of one per key.
+    """
+    shards = []
+    append = shards.append
+    rot = _ROT
+    for key in keys:
+        if isinstance(key, unicode):
+            key = key.encode('utf8')
+        hash_val = prefix
+        for c in bytearray(key):
+            hash_val = (hash_val + rot[c]) * 11
+        append(hash_val % num_shards)
+    return shards
+
+
+def mmh3_shard_num_for_key(key, num_shards):
+    """MurmurHash3-based shard mapping.
+
+    Better avalanche (and so better shard balance) than the legacy
+    rolling hash, but a different mapping entirely: all agent instances
+    syncing a zone must agree on the algorithm. Requires the optional
+    mmh3 package; ``& 0xffffffff`` makes the 32-bit result unsigned on
+    every mmh3 version.
+    """
+    if mmh3 is None:
+        raise ImportError(
+            'the mmh3 package is required for the mmh3 shard hash')
+    if isinstance(key, unicode):
+        key = key.encode('utf8')
+    return (mmh3.hash(key) & 0xffffffff) % num_shards